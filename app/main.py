@@ -1,102 +1,162 @@
 import asyncio
+import json
+import time
 from contextlib import asynccontextmanager
 from pathlib import Path
 
-import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-
-from collections import deque
-from datetime import datetime
+from starlette.background import BackgroundTask
 
 from .config import get_settings
 from .sonarr import (
     SonarrClient,
-    get_episodes_to_remove,
+    build_retention_index,
+    cleanup_series,
+    compute_episodes_to_remove,
+    fetch_series_bundles,
     get_retention_for_series,
+    retention_args,
+    trimarr_tag_ids,
 )
 
 
+def _cleanup_message(
+    series: dict, deleted: int, unmonitored: int, episodes_deleted: list[dict], dry_run: bool
+) -> str:
+    msg = f"{series['title']}: {'would ' if dry_run else ''}delete {deleted} files, unmonitor {unmonitored} episodes"
+    if episodes_deleted:
+        ep_details = "; ".join(
+            f"S{ep.get('seasonNumber', '?')}E{ep.get('episodeNumber', '?')} {ep.get('title', '')}"
+            for ep in episodes_deleted[:10]
+        )
+        if len(episodes_deleted) > 10:
+            ep_details += f" ... +{len(episodes_deleted) - 10} more"
+        msg += f" | Episodes: {ep_details}"
+    return msg
+
+
+def _log_cleanup_results(results: list, dry_run: bool, prefix: str = "") -> tuple[int, int, int]:
+    total_deleted = 0
+    total_unmonitored = 0
+    failed = 0
+    for s, deleted, unmonitored, episodes_deleted, error in results:
+        total_deleted += deleted
+        total_unmonitored += unmonitored
+        if error is None or deleted:
+            msg = prefix + _cleanup_message(s, deleted, unmonitored, episodes_deleted, dry_run)
+            log("info", msg, series_id=s["id"], series_title=s["title"], dry_run=dry_run)
+        if error is not None:
+            failed += 1
+            log("error", f"{prefix}{s['title']}: cleanup failed: {error}", series_id=s["id"], series_title=s["title"], dry_run=dry_run)
+    return total_deleted, total_unmonitored, failed
+
+
+async def _run_scheduled_pass(settings):
+    try:
+        sonarr = get_sonarr()
+        series = await sonarr.get_series(fresh=True)
+        tags = await sonarr.get_tags(fresh=True)
+        retention_index = build_retention_index(tags)
+        filtered = SonarrClient.filter_series_with_trimarr_tags(
+            series, trimarr_tag_ids(retention_index)
+        )
+        if not filtered:
+            return
+        effective_dry_run = settings.dry_run
+        results = await cleanup_series(sonarr, filtered, retention_index, effective_dry_run)
+        total_deleted, total_unmonitored, failed = _log_cleanup_results(
+            results, effective_dry_run, prefix="Scheduled: "
+        )
+        log("info", f"Scheduled cleanup complete: {total_deleted} files, {total_unmonitored} episodes across {len(filtered)} series ({failed} failed)")
+    except Exception as e:
+        log("error", f"Scheduled cleanup failed: {e}")
+
+
+SCHEDULER_POLL_SECONDS = 60.0
+
+
 async def run_scheduled_cleanup(app: FastAPI):
     settings = get_settings()
     if settings.run_interval_hours <= 0:
         return
-    while True:
-        await asyncio.sleep(settings.run_interval_hours * 3600)
+    interval = settings.run_interval_hours * 3600
+    stop = app.state.scheduler_stop
+    deadline = time.monotonic() + interval
+    while not stop.is_set():
+        if time.monotonic() >= deadline:
+            await _run_scheduled_pass(settings)
+            deadline += interval
+            if deadline <= time.monotonic():
+                deadline = time.monotonic() + interval
+        timeout = min(SCHEDULER_POLL_SECONDS, max(1.0, deadline - time.monotonic()))
         try:
-            sonarr = get_sonarr()
-            series = await sonarr.get_series()
-            tags = await sonarr.get_tags()
-            filtered = SonarrClient.filter_series_with_trimarr_tags(series, tags)
-            if not filtered:
-                continue
-            effective_dry_run = settings.dry_run
-            total_deleted = 0
-            total_unmonitored = 0
-            for s in filtered:
-                rule = get_retention_for_series(s, tags)
-                if not rule:
-                    continue
-                keep_seasons = rule.get("seasons")
-                keep_episodes = rule.get("episodes")
-                combined = (keep_seasons, keep_episodes) if keep_seasons and keep_episodes else None
-                episodes = await sonarr.get_episodes(s["id"])
-                episode_files = await sonarr.get_episode_files(s["id"])
-                to_unmonitor, to_delete, episodes_deleted = get_episodes_to_remove(
-                    episodes, episode_files, keep_seasons, keep_episodes, combined
-                )
-                if not effective_dry_run:
-                    for ef_id in to_delete:
-                        await sonarr.delete_episode_file(ef_id)
-                        total_deleted += 1
-                    if to_unmonitor:
-                        await sonarr.set_episode_monitored(to_unmonitor, False)
-                        total_unmonitored += len(to_unmonitor)
-                else:
-                    total_deleted += len(to_delete)
-                    total_unmonitored += len(to_unmonitor)
-                msg = f"Scheduled: {s['title']}: {'would ' if effective_dry_run else ''}delete {len(to_delete)} files, unmonitor {len(to_unmonitor)} episodes"
-                if episodes_deleted:
-                    ep_details = "; ".join(
-                        f"S{ep.get('seasonNumber', '?')}E{ep.get('episodeNumber', '?')} {ep.get('title', '')}"
-                        for ep in episodes_deleted[:10]
-                    )
-                    if len(episodes_deleted) > 10:
-                        ep_details += f" ... +{len(episodes_deleted) - 10} more"
-                    msg += f" | Episodes: {ep_details}"
-                log("info", msg, series_id=s["id"], series_title=s["title"], dry_run=effective_dry_run)
-            log("info", f"Scheduled cleanup complete: {total_deleted} files, {total_unmonitored} episodes across {len(filtered)} series")
-        except Exception as e:
-            log("error", f"Scheduled cleanup failed: {e}")
+            await asyncio.wait_for(stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.sonarr = None
+    app.state.scheduler_stop = asyncio.Event()
+    scheduler = None
     settings = get_settings()
     if settings.run_interval_hours > 0:
         log("info", f"Scheduler enabled: cleanup every {settings.run_interval_hours}h")
-        asyncio.create_task(run_scheduled_cleanup(app))
+        scheduler = asyncio.create_task(run_scheduled_cleanup(app))
     yield
+    app.state.scheduler_stop.set()
+    if scheduler:
+        await scheduler
     if app.state.sonarr:
         await app.state.sonarr.close()
 
 
-app = FastAPI(title="Trimarr", lifespan=lifespan)
+app = FastAPI(title="Trimarr", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+class RingLog:
+    __slots__ = ("buf", "idx", "n")
+
+    def __init__(self, n: int = 500):
+        self.buf: list[str | None] = [None] * n
+        self.idx = 0
+        self.n = n
+
+    def append(self, entry: str) -> None:
+        self.buf[self.idx] = entry
+        self.idx = (self.idx + 1) % self.n
+
+    def snapshot(self) -> list[str]:
+        i = self.idx
+        return [x for x in self.buf[i:] + self.buf[:i] if x is not None]
+
+
+LOG_BUFFER = RingLog(500)
 
-LOG_BUFFER: deque[dict] = deque(maxlen=500)
+_last_sec = [0]
+_last_str = [""]
+
+
+def _ts() -> str:
+    sec = int(time.time())
+    if sec != _last_sec[0]:
+        _last_sec[0] = sec
+        _last_str[0] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sec))
+    return _last_str[0]
 
 
 def log(level: str, message: str, **kwargs):
     entry = {
-        "time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "time": _ts(),
         "level": level,
         "message": message,
         **kwargs,
     }
-    LOG_BUFFER.append(entry)
+    LOG_BUFFER.append(json.dumps(entry))
 
 
 def get_sonarr() -> SonarrClient:
@@ -165,36 +225,51 @@ def _format_retention(rule: dict) -> str:
     return ""
 
 
+POSTER_PROXY_PREFIX = "/api/proxy/sonarr/"
+
+
 def _poster_url(series: dict, use_proxy: bool = True) -> str | None:
-    for img in series.get("images") or []:
-        if img.get("coverType") == "poster":
-            if img.get("url"):
-                path = img["url"].lstrip("/")
-                if use_proxy:
-                    return f"/api/proxy/sonarr/{path}"
-                return path
-            if img.get("remoteUrl"):
-                return img["remoteUrl"]
+    imgs = series.get("images") or ()
+    for img in imgs:
+        if img.get("coverType") != "poster":
+            continue
+        url = img.get("url")
+        if url:
+            path = url.lstrip("/")
+            return POSTER_PROXY_PREFIX + path if use_proxy else path
+        if img.get("remoteUrl"):
+            return img["remoteUrl"]
     return None
 
 
+IMAGE_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+
 @app.get("/api/proxy/sonarr/{path:path}")
-async def proxy_sonarr_image(path: str):
-    settings = get_settings()
-    url = f"{settings.sonarr_url.rstrip('/')}/{path}"
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            r = await client.get(
-                url,
-                headers={"X-Api-Key": settings.sonarr_api_key},
-            )
-            r.raise_for_status()
-        except httpx.HTTPStatusError:
-            raise HTTPException(404, "Image not found")
-        return Response(
-            content=r.content,
-            media_type=r.headers.get("content-type", "image/jpeg"),
-        )
+async def proxy_sonarr_image(path: str, request: Request):
+    sonarr = get_sonarr()
+    conditional = {
+        k: request.headers[k]
+        for k in ("if-none-match", "if-modified-since")
+        if request.headers.get(k)
+    }
+    r = await sonarr.stream_raw(path, headers=conditional)
+    if r.status_code != 304 and not r.is_success:
+        await r.aclose()
+        raise HTTPException(404, "Image not found")
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL}
+    for k in ("etag", "last-modified", "content-encoding"):
+        if r.headers.get(k):
+            headers[k] = r.headers[k]
+    if r.status_code == 304:
+        await r.aclose()
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        r.aiter_raw(),
+        media_type=r.headers.get("content-type", "image/jpeg"),
+        headers=headers,
+        background=BackgroundTask(r.aclose),
+    )
 
 
 @app.get("/api/trimarr-series")
@@ -203,20 +278,20 @@ async def list_trimarr_series():
     sonarr = get_sonarr()
     series = await sonarr.get_series()
     tags = await sonarr.get_tags()
+    retention_index = build_retention_index(tags)
     quality_profiles = await sonarr.get_quality_profiles()
     qp_by_id = {qp["id"]: qp.get("name", "") for qp in quality_profiles}
-    filtered = SonarrClient.filter_series_with_trimarr_tags(series, tags)
+    filtered = SonarrClient.filter_series_with_trimarr_tags(
+        series, trimarr_tag_ids(retention_index)
+    )
     result = []
-    for s in filtered:
-        rule = get_retention_for_series(s, tags)
+    bundles = await fetch_series_bundles(sonarr, filtered)
+    for s, (episodes, episode_files) in zip(filtered, bundles):
+        rule = get_retention_for_series(s, retention_index)
         if not rule:
             continue
-        keep_seasons = rule.get("seasons")
-        keep_episodes = rule.get("episodes")
-        combined = (keep_seasons, keep_episodes) if keep_seasons and keep_episodes else None
-        episodes = await sonarr.get_episodes(s["id"])
-        episode_files = await sonarr.get_episode_files(s["id"])
-        to_unmonitor, to_delete, episodes_deleted = get_episodes_to_remove(
+        keep_seasons, keep_episodes, combined = retention_args(rule)
+        to_unmonitor, to_delete, episodes_deleted = await compute_episodes_to_remove(
             episodes, episode_files,
             keep_seasons if not combined else None,
             keep_episodes if not combined else None,
@@ -231,9 +306,7 @@ async def list_trimarr_series():
                 "qualityProfile": qp_by_id.get(s.get("qualityProfileId")) or (s.get("qualityProfile") or {}).get("name"),
                 "seasonCount": s.get("seasonCount", 0),
                 "episodeFileCount": len(episode_files),
-                "totalEpisodeCount": sum(
-                    1 for e in episodes if e.get("seasonNumber", 0) >= 0
-                ),
+                "totalEpisodeCount": len(episodes),
                 "posterUrl": _poster_url(s),
                 "retentionLabel": retention_label,
                 "episodesToUnmonitor": len(to_unmonitor),
@@ -263,10 +336,9 @@ async def preview_cleanup(req: CleanupPreviewRequest):
         return {"preview": [], "tag": req.tag}
 
     preview = []
-    for s in filtered:
-        episodes = await sonarr.get_episodes(s["id"])
-        episode_files = await sonarr.get_episode_files(s["id"])
-        to_unmonitor, to_delete, _ = get_episodes_to_remove(
+    bundles = await fetch_series_bundles(sonarr, filtered)
+    for s, (episodes, episode_files) in zip(filtered, bundles):
+        to_unmonitor, to_delete, _ = await compute_episodes_to_remove(
             episodes, episode_files, req.keep_seasons, req.keep_episodes
         )
         if to_unmonitor or to_delete:
@@ -294,15 +366,17 @@ async def execute_cleanup(req: CleanupExecuteRequest):
     effective_dry_run = req.dry_run or get_settings().dry_run
     log("info", f"Cleanup started (dry_run={effective_dry_run}, series_ids={req.series_ids})")
     sonarr = get_sonarr()
-    series = await sonarr.get_series()
-    tags = await sonarr.get_tags()
+    series = await sonarr.get_series(fresh=True)
+    tags = await sonarr.get_tags(fresh=True)
+    retention_index = build_retention_index(tags)
 
     if req.series_ids:
-        filtered = [
-            s for s in series
-            if s["id"] in req.series_ids
-            and get_retention_for_series(s, tags) is not None
-        ]
+        requested_ids = set(req.series_ids)
+        filtered = SonarrClient.filter_series_with_trimarr_tags(
+            [s for s in series if s["id"] in requested_ids],
+            trimarr_tag_ids(retention_index),
+            monitored_only=False,
+        )
         use_tag_rules = True
     elif req.tag and (req.keep_seasons is not None or req.keep_episodes is not None):
         if (req.keep_seasons is None) == (req.keep_episodes is None):
@@ -317,60 +391,29 @@ async def execute_cleanup(req: CleanupExecuteRequest):
         )
 
     if not filtered:
-        return {"deleted": 0, "unmonitored": 0, "series_processed": 0}
+        return {"deleted": 0, "unmonitored": 0, "failed": 0, "series_processed": 0}
 
-    total_deleted = 0
-    total_unmonitored = 0
-    for s in filtered:
-        if use_tag_rules:
-            rule = get_retention_for_series(s, tags)
-            if not rule:
-                continue
-            keep_seasons = rule.get("seasons")
-            keep_episodes = rule.get("episodes")
-            combined = (keep_seasons, keep_episodes) if keep_seasons and keep_episodes else None
-        else:
-            keep_seasons = req.keep_seasons
-            keep_episodes = req.keep_episodes
-            combined = None
-
-        episodes = await sonarr.get_episodes(s["id"])
-        episode_files = await sonarr.get_episode_files(s["id"])
-        to_unmonitor, to_delete, episodes_deleted = get_episodes_to_remove(
-            episodes, episode_files, keep_seasons, keep_episodes, combined
-        )
-        if not effective_dry_run:
-            for ef_id in to_delete:
-                await sonarr.delete_episode_file(ef_id)
-                total_deleted += 1
-            if to_unmonitor:
-                await sonarr.set_episode_monitored(to_unmonitor, False)
-                total_unmonitored += len(to_unmonitor)
-        else:
-            total_deleted += len(to_delete)
-            total_unmonitored += len(to_unmonitor)
-
-        msg = f"{s['title']}: {'would ' if effective_dry_run else ''}delete {len(to_delete)} files, unmonitor {len(to_unmonitor)} episodes"
-        if episodes_deleted:
-            ep_details = "; ".join(
-                f"S{ep.get('seasonNumber', '?')}E{ep.get('episodeNumber', '?')} {ep.get('title', '')}"
-                for ep in episodes_deleted[:10]
-            )
-            if len(episodes_deleted) > 10:
-                ep_details += f" ... +{len(episodes_deleted) - 10} more"
-            msg += f" | Episodes: {ep_details}"
-        log("info", msg, series_id=s["id"], series_title=s["title"], dry_run=effective_dry_run)
+    results = await cleanup_series(
+        sonarr,
+        filtered,
+        retention_index,
+        effective_dry_run,
+        keep=None if use_tag_rules else (req.keep_seasons, req.keep_episodes),
+    )
+    total_deleted, total_unmonitored, failed = _log_cleanup_results(results, effective_dry_run)
 
     return {
         "deleted": total_deleted,
         "unmonitored": total_unmonitored,
+        "failed": failed,
         "series_processed": len(filtered),
     }
 
 
 @app.get("/api/logs")
 async def get_logs():
-    return {"logs": list(LOG_BUFFER)}
+    body = '{"logs": [' + ", ".join(LOG_BUFFER.snapshot()) + "]}"
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/debug/episode-structure")
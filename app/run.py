@@ -1,45 +1,36 @@
-import asyncio
 import sys
 
+import uvloop
+
 from .config import get_settings
 from .sonarr import (
     SonarrClient,
-    get_episodes_to_remove,
-    get_retention_for_series,
+    build_retention_index,
+    cleanup_series,
+    trimarr_tag_ids,
 )
 
 
-async def run_cleanup_once(sonarr: SonarrClient, settings) -> tuple[int, int, int]:
-    series = await sonarr.get_series()
-    tags = await sonarr.get_tags()
-    filtered = SonarrClient.filter_series_with_trimarr_tags(series, tags)
+async def run_cleanup_once(sonarr: SonarrClient, settings) -> tuple[int, int, int, int]:
+    series = await sonarr.get_series(fresh=True)
+    tags = await sonarr.get_tags(fresh=True)
+    retention_index = build_retention_index(tags)
+    filtered = SonarrClient.filter_series_with_trimarr_tags(
+        series, trimarr_tag_ids(retention_index)
+    )
     if not filtered:
-        return 0, 0, 0
+        return 0, 0, 0, 0
+    results = await cleanup_series(sonarr, filtered, retention_index, settings.dry_run)
     total_deleted = 0
     total_unmonitored = 0
-    for s in filtered:
-        rule = get_retention_for_series(s, tags)
-        if not rule:
-            continue
-        keep_seasons = rule.get("seasons")
-        keep_episodes = rule.get("episodes")
-        combined = (keep_seasons, keep_episodes) if keep_seasons and keep_episodes else None
-        episodes = await sonarr.get_episodes(s["id"])
-        episode_files = await sonarr.get_episode_files(s["id"])
-        to_unmonitor, to_delete, _ = get_episodes_to_remove(
-            episodes, episode_files, keep_seasons, keep_episodes, combined
-        )
-        if not settings.dry_run:
-            for ef_id in to_delete:
-                await sonarr.delete_episode_file(ef_id)
-                total_deleted += 1
-            if to_unmonitor:
-                await sonarr.set_episode_monitored(to_unmonitor, False)
-                total_unmonitored += len(to_unmonitor)
-        else:
-            total_deleted += len(to_delete)
-            total_unmonitored += len(to_unmonitor)
-    return total_deleted, total_unmonitored, len(filtered)
+    failed = 0
+    for s, deleted, unmonitored, _, error in results:
+        total_deleted += deleted
+        total_unmonitored += unmonitored
+        if error is not None:
+            failed += 1
+            print(f"{s['title']}: cleanup failed after deleting {deleted} files: {error}", file=sys.stderr)
+    return total_deleted, total_unmonitored, len(filtered), failed
 
 
 async def main():
@@ -49,12 +40,14 @@ async def main():
         sys.exit(1)
     sonarr = SonarrClient(settings.sonarr_url, settings.sonarr_api_key)
     try:
-        deleted, unmonitored, processed = await run_cleanup_once(sonarr, settings)
+        deleted, unmonitored, processed, failed = await run_cleanup_once(sonarr, settings)
         mode = "would " if settings.dry_run else ""
-        print(f"Cleanup: {mode}deleted {deleted} files, {mode}unmonitored {unmonitored} episodes across {processed} series")
+        print(f"Cleanup: {mode}deleted {deleted} files, {mode}unmonitored {unmonitored} episodes across {processed} series ({failed} failed)")
     finally:
         await sonarr.close()
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
@@ -1,31 +1,44 @@
+import asyncio
+import heapq
 import re
+import time
 import httpx
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 
-TRIMARR_TAG_PATTERNS = [
-    (re.compile(r"^trimarr_retain_(\d+)_seasons?$", re.I), "seasons"),
-    (re.compile(r"^trimarr_retain_(\d+)_episodes?$", re.I), "episodes"),
-]
+TRIMARR_TAG_PATTERN = re.compile(
+    r"trimarr_retain_(?:(?P<seasons>\d+)_seasons?|(?P<episodes>\d+)_episodes?)"
+)
 
 
 def parse_retention_from_tag(tag_label: str) -> tuple[str, int] | None:
-    for pattern, mode in TRIMARR_TAG_PATTERNS:
-        m = pattern.match(tag_label.strip())
-        if m:
-            return (mode, int(m.group(1)))
-    return None
+    m = TRIMARR_TAG_PATTERN.fullmatch(tag_label.strip().lower())
+    if not m:
+        return None
+    if m.group("seasons"):
+        return ("seasons", int(m.group("seasons")))
+    return ("episodes", int(m.group("episodes")))
+
+
+def build_retention_index(
+    tags: list[dict[str, Any]],
+) -> dict[int, tuple[str, int] | None]:
+    return {t["id"]: parse_retention_from_tag(t["label"]) for t in tags}
+
+
+def trimarr_tag_ids(
+    retention_index: dict[int, tuple[str, int] | None],
+) -> set[int]:
+    return {tag_id for tag_id, rule in retention_index.items() if rule and rule[1] >= 1}
 
 
 def get_retention_for_series(
     series: dict[str, Any],
-    tags: list[dict[str, Any]],
+    retention_index: dict[int, tuple[str, int] | None],
 ) -> dict[str, int] | None:
-    tag_id_to_label = {t["id"]: t["label"] for t in tags}
     result: dict[str, int] = {}
     for tag_id in series.get("tags") or []:
-        label = tag_id_to_label.get(tag_id, "")
-        rule = parse_retention_from_tag(label)
+        rule = retention_index.get(tag_id)
         if rule:
             mode, count = rule
             if count >= 1:
@@ -33,11 +46,28 @@ def get_retention_for_series(
     return result if result else None
 
 
+SERIES_FETCH_CONCURRENCY = 8
+OFFLOAD_EPISODE_THRESHOLD = 500
+SERIES_CACHE_TTL = 30.0
+TAGS_CACHE_TTL = 300.0
+QUALITY_PROFILES_CACHE_TTL = 300.0
+
+
+class EpisodeFileDeleteError(Exception):
+    def __init__(self, deleted_ids: list[int], attempted: int, error: Exception):
+        super().__init__(
+            f"deleted {len(deleted_ids)} of {attempted} episode files: {error}"
+        )
+        self.deleted_ids = deleted_ids
+
+
 class SonarrClient:
     def __init__(self, base_url: str, api_key: str):
         self.base_url = base_url.rstrip("/")
         self.api_key = api_key
         self._client: httpx.AsyncClient | None = None
+        self._root_client: httpx.AsyncClient | None = None
+        self._cache: dict[str, tuple[float, Any]] = {}
 
     def _headers(self) -> dict[str, str]:
         return {"X-Api-Key": self.api_key}
@@ -48,31 +78,83 @@ class SonarrClient:
                 base_url=f"{self.base_url}/api/v3",
                 headers=self._headers(),
                 timeout=30.0,
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=32,
+                    max_keepalive_connections=32,
+                    keepalive_expiry=60.0,
+                ),
             )
         return self._client
 
+    async def _get_root_client(self) -> httpx.AsyncClient:
+        if self._root_client is None:
+            self._root_client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self._headers(),
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+            )
+        return self._root_client
+
     async def close(self):
         if self._client:
             await self._client.aclose()
             self._client = None
+        if self._root_client:
+            await self._root_client.aclose()
+            self._root_client = None
 
-    async def get_series(self) -> list[dict[str, Any]]:
-        client = await self._get_client()
-        r = await client.get("/series")
-        r.raise_for_status()
-        return r.json()
+    async def stream_raw(
+        self, path: str, headers: dict[str, str] | None = None
+    ) -> httpx.Response:
+        client = await self._get_root_client()
+        request = client.build_request("GET", f"/{path.lstrip('/')}", headers=headers)
+        return await client.send(request, stream=True)
+
+    async def _cached(
+        self,
+        key: str,
+        ttl: float,
+        fetch: Callable[[], Awaitable[Any]],
+        fresh: bool = False,
+    ) -> Any:
+        now = time.monotonic()
+        hit = None if fresh else self._cache.get(key)
+        if hit and now - hit[0] < ttl:
+            return hit[1]
+        data = await fetch()
+        self._cache[key] = (now, data)
+        return data
 
-    async def get_tags(self) -> list[dict[str, Any]]:
+    def invalidate(self, key: str | None = None) -> None:
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    async def _get_json(self, path: str) -> Any:
         client = await self._get_client()
-        r = await client.get("/tag")
+        r = await client.get(path)
         r.raise_for_status()
         return r.json()
 
+    async def get_series(self, fresh: bool = False) -> list[dict[str, Any]]:
+        return await self._cached(
+            "series", SERIES_CACHE_TTL, lambda: self._get_json("/series"), fresh
+        )
+
+    async def get_tags(self, fresh: bool = False) -> list[dict[str, Any]]:
+        return await self._cached(
+            "tags", TAGS_CACHE_TTL, lambda: self._get_json("/tag"), fresh
+        )
+
     async def get_quality_profiles(self) -> list[dict[str, Any]]:
-        client = await self._get_client()
-        r = await client.get("/qualityprofile")
-        r.raise_for_status()
-        return r.json()
+        return await self._cached(
+            "quality_profiles",
+            QUALITY_PROFILES_CACHE_TTL,
+            lambda: self._get_json("/qualityprofile"),
+        )
 
     async def get_episodes(self, series_id: int) -> list[dict[str, Any]]:
         client = await self._get_client()
@@ -90,6 +172,32 @@ class SonarrClient:
         client = await self._get_client()
         r = await client.delete(f"/episodefile/{episode_file_id}")
         r.raise_for_status()
+        self.invalidate("series")
+
+    async def delete_episode_files_bulk(self, episode_file_ids: list[int]) -> None:
+        if not episode_file_ids:
+            return
+        client = await self._get_client()
+        r = await client.request(
+            "DELETE",
+            "/episodefile/bulk",
+            json={"episodeFileIds": episode_file_ids},
+        )
+        if r.status_code in (404, 405):
+            deleted: list[int] = []
+            first_error: Exception | None = None
+            for episode_file_id in episode_file_ids:
+                try:
+                    await self.delete_episode_file(episode_file_id)
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                deleted.append(episode_file_id)
+            if first_error is not None:
+                raise EpisodeFileDeleteError(deleted, len(episode_file_ids), first_error)
+            return
+        r.raise_for_status()
+        self.invalidate("series")
 
     async def set_episode_monitored(
         self, episode_ids: list[int], monitored: bool
@@ -102,11 +210,13 @@ class SonarrClient:
             json={"episodeIds": episode_ids, "monitored": monitored},
         )
         r.raise_for_status()
+        self.invalidate("series")
 
     async def update_series(self, series: dict[str, Any]) -> dict[str, Any]:
         client = await self._get_client()
         r = await client.put("/series", json=series)
         r.raise_for_status()
+        self.invalidate("series")
         return r.json()
 
     @staticmethod
@@ -130,17 +240,51 @@ class SonarrClient:
     @staticmethod
     def filter_series_with_trimarr_tags(
         series: list[dict[str, Any]],
-        tags: list[dict[str, Any]],
+        trimarr_tag_ids: set[int],
         monitored_only: bool = True,
     ) -> list[dict[str, Any]]:
-        out = [
+        if not trimarr_tag_ids:
+            return []
+        return [
             s
             for s in series
-            if get_retention_for_series(s, tags) is not None
+            if (not monitored_only or s.get("monitored", True))
+            and not trimarr_tag_ids.isdisjoint(s.get("tags") or ())
         ]
-        if monitored_only:
-            out = [s for s in out if s.get("monitored", True)]
-        return out
+
+
+def retention_args(
+    rule: dict[str, int],
+) -> tuple[int | None, int | None, tuple[int, int] | None]:
+    keep_seasons = rule.get("seasons")
+    keep_episodes = rule.get("episodes")
+    combined = (keep_seasons, keep_episodes) if keep_seasons and keep_episodes else None
+    return keep_seasons, keep_episodes, combined
+
+
+async def fetch_series_bundle(
+    sonarr: SonarrClient,
+    series_id: int,
+    sem: asyncio.Semaphore,
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+    async with sem:
+        episodes, episode_files = await asyncio.gather(
+            sonarr.get_episodes(series_id),
+            sonarr.get_episode_files(series_id),
+        )
+    return episodes, episode_files
+
+
+async def fetch_series_bundles(
+    sonarr: SonarrClient,
+    series: list[dict[str, Any]],
+    sem: asyncio.Semaphore | None = None,
+) -> list[tuple[list[dict[str, Any]], list[dict[str, Any]]]]:
+    if sem is None:
+        sem = asyncio.Semaphore(SERIES_FETCH_CONCURRENCY)
+    return await asyncio.gather(
+        *[fetch_series_bundle(sonarr, s["id"], sem) for s in series]
+    )
 
 
 def get_episodes_to_remove(
@@ -155,68 +299,165 @@ def get_episodes_to_remove(
     episodes_to_delete: list[dict[str, Any]] = []
     seen_files: set[int] = set()
 
-    episode_file_by_episode: dict[int, int] = {}
-    for ef in episode_files:
-        eids = ef.get("episodeIds") or ef.get("episode_ids")
-        if not eids:
-            eid = ef.get("episodeId") or ef.get("episode_id")
-            eids = [eid] if eid is not None else []
-        for eid in eids:
-            if eid is not None:
-                episode_file_by_episode[eid] = ef["id"]
-
-    def add_file_for_episode(ep: dict[str, Any]) -> None:
-        ef_id = ep.get("episodeFileId") or ep.get("episode_file_id")
-        if ef_id is None and ep.get("episodeFile"):
-            ef_id = ep["episodeFile"].get("id") if isinstance(ep["episodeFile"], dict) else None
-        if ef_id is None and ep.get("episode_file"):
-            ef_id = ep["episode_file"].get("id") if isinstance(ep["episode_file"], dict) else None
+    _ef_map: dict[int, int] | None = None
+
+    def _get_ef_map() -> dict[int, int]:
+        nonlocal _ef_map
+        if _ef_map is None:
+            m: dict[int, int] = {}
+            for ef in episode_files:
+                eids = ef.get("episodeIds") or ef.get("episode_ids")
+                if not eids:
+                    eid = ef.get("episodeId") or ef.get("episode_id")
+                    eids = [eid] if eid is not None else []
+                for eid in eids:
+                    if eid is not None:
+                        m[eid] = ef["id"]
+            _ef_map = m
+        return _ef_map
+
+    # One pass over episodes: (episode, season, has_file, air_date, inline file id)
+    rows: list[tuple[dict[str, Any], int, bool, str, int | None]] = []
+    by_season: dict[int, list[tuple[dict[str, Any], int, bool, str, int | None]]] = {}
+    seasons_with_files_set: set[int] = set()
+    for e in episodes:
+        season = e["seasonNumber"]
+        inline_ef_id = e.get("episodeFileId") or e.get("episode_file_id")
+        has_file = e.get("hasFile", e.get("has_file", bool(inline_ef_id)))
+        air = e.get("airDateUtc") or e.get("airDate") or ""
+        ef_id = inline_ef_id
         if ef_id is None:
-            ef_id = episode_file_by_episode.get(ep["id"])
-        if ef_id is not None and ef_id not in seen_files:
-            episode_file_ids_to_delete.append(ef_id)
-            episode_ids_to_unmonitor.append(ep["id"])
-            episodes_to_delete.append(ep)
-            seen_files.add(ef_id)
+            ef = e.get("episodeFile")
+            if ef:
+                ef_id = ef.get("id") if isinstance(ef, dict) else None
+        if ef_id is None:
+            ef = e.get("episode_file")
+            if ef:
+                ef_id = ef.get("id") if isinstance(ef, dict) else None
+        row = (e, season, has_file, air, ef_id)
+        rows.append(row)
+        by_season.setdefault(season, []).append(row)
+        if season >= 0 and has_file:
+            seasons_with_files_set.add(season)
 
-    def _air_date(e):
-        return e.get("airDateUtc") or e.get("airDate") or ""
-    def _has_file(e):
-        return e.get("hasFile", e.get("has_file", bool(e.get("episodeFileId") or e.get("episode_file_id"))))
+    seasons_with_files = sorted(seasons_with_files_set, reverse=True)
 
-    seasons_with_files = sorted(
-        {e["seasonNumber"] for e in episodes if e["seasonNumber"] >= 0 and _has_file(e)},
-        reverse=True,
-    )
+    def _row_air_date(row):
+        return row[3]
 
     if keep_seasons_plus_episodes is not None:
         keep_seasons_count, keep_episodes_count = keep_seasons_plus_episodes
         seasons_full_keep = set(seasons_with_files[:keep_seasons_count])
         boundary_season = seasons_with_files[keep_seasons_count] if keep_seasons_count < len(seasons_with_files) else None
         keep_ids: set[int] = set()
-        for e in episodes:
-            if e["seasonNumber"] in seasons_full_keep:
-                keep_ids.add(e["id"])
-            elif boundary_season is not None and e["seasonNumber"] == boundary_season:
-                pass
-        boundary_episodes = [e for e in episodes if e["seasonNumber"] == boundary_season and _has_file(e) and _air_date(e)]
-        boundary_episodes.sort(key=_air_date, reverse=True)
-        keep_ids.update(e["id"] for e in boundary_episodes[:keep_episodes_count])
-        episodes_to_remove = [e for e in episodes if e["id"] not in keep_ids]
+        for season in seasons_full_keep:
+            keep_ids.update(row[0]["id"] for row in by_season[season])
+        boundary_rows = [row for row in by_season.get(boundary_season, ()) if row[2] and row[3]]
+        keep_ids.update(
+            row[0]["id"]
+            for row in heapq.nlargest(keep_episodes_count, boundary_rows, key=_row_air_date)
+        )
+        rows_to_remove = [row for row in rows if row[0]["id"] not in keep_ids]
     elif keep_seasons is not None:
         seasons_to_keep = set(seasons_with_files[:keep_seasons])
-        episodes_to_remove = [
-            e for e in episodes if e["seasonNumber"] not in seasons_to_keep
-        ]
+        rows_to_remove = [row for row in rows if row[1] not in seasons_to_keep]
     elif keep_episodes is not None and keep_episodes >= 1:
-        episodes_with_files = [e for e in episodes if _has_file(e) and _air_date(e)]
-        sorted_with_files = sorted(episodes_with_files, key=_air_date, reverse=True)
-        keep_ids = {e["id"] for e in sorted_with_files[:keep_episodes]}
-        episodes_to_remove = [e for e in episodes if e["id"] not in keep_ids]
+        rows_with_files = (row for row in rows if row[2] and row[3])
+        keep_ids = {
+            row[0]["id"]
+            for row in heapq.nlargest(keep_episodes, rows_with_files, key=_row_air_date)
+        }
+        rows_to_remove = [row for row in rows if row[0]["id"] not in keep_ids]
     else:
         return [], [], []
 
-    for ep in episodes_to_remove:
-        add_file_for_episode(ep)
+    for ep, _, _, _, ef_id in rows_to_remove:
+        if ef_id is None:
+            ef_id = _get_ef_map().get(ep["id"])
+        if ef_id is not None and ef_id not in seen_files:
+            episode_file_ids_to_delete.append(ef_id)
+            episode_ids_to_unmonitor.append(ep["id"])
+            episodes_to_delete.append(ep)
+            seen_files.add(ef_id)
 
     return episode_ids_to_unmonitor, episode_file_ids_to_delete, episodes_to_delete
+
+
+async def compute_episodes_to_remove(
+    episodes: list[dict[str, Any]],
+    episode_files: list[dict[str, Any]],
+    keep_seasons: int | None,
+    keep_episodes: int | None,
+    keep_seasons_plus_episodes: tuple[int, int] | None = None,
+) -> tuple[list[int], list[int], list[dict[str, Any]]]:
+    args = (episodes, episode_files, keep_seasons, keep_episodes, keep_seasons_plus_episodes)
+    if len(episodes) > OFFLOAD_EPISODE_THRESHOLD:
+        return await asyncio.to_thread(get_episodes_to_remove, *args)
+    return get_episodes_to_remove(*args)
+
+
+async def process_series(
+    sonarr: SonarrClient,
+    series: dict[str, Any],
+    keep_seasons: int | None,
+    keep_episodes: int | None,
+    combined: tuple[int, int] | None,
+    dry_run: bool,
+    sem: asyncio.Semaphore,
+) -> tuple[int, int, list[dict[str, Any]], Exception | None]:
+    episodes, episode_files = await fetch_series_bundle(sonarr, series["id"], sem)
+    to_unmonitor, to_delete, episodes_deleted = await compute_episodes_to_remove(
+        episodes, episode_files, keep_seasons, keep_episodes, combined
+    )
+    if dry_run:
+        return len(to_delete), len(to_unmonitor), episodes_deleted, None
+    deleted = 0
+    error: Exception | None = None
+    try:
+        async with sem:
+            try:
+                await sonarr.delete_episode_files_bulk(to_delete)
+            except EpisodeFileDeleteError as e:
+                # Per-file fallback failed partway: only unmonitor what is gone.
+                deleted_ids = set(e.deleted_ids)
+                kept = [i for i, ef_id in enumerate(to_delete) if ef_id in deleted_ids]
+                to_unmonitor = [to_unmonitor[i] for i in kept]
+                episodes_deleted = [episodes_deleted[i] for i in kept]
+                error = e
+            deleted = len(episodes_deleted)
+            await sonarr.set_episode_monitored(to_unmonitor, False)
+    except Exception as e:
+        return deleted, 0, episodes_deleted if deleted else [], e
+    return deleted, len(to_unmonitor), episodes_deleted, error
+
+
+async def cleanup_series(
+    sonarr: SonarrClient,
+    series: list[dict[str, Any]],
+    retention_index: dict[int, tuple[str, int] | None],
+    dry_run: bool,
+    keep: tuple[int | None, int | None] | None = None,
+) -> list[tuple[dict[str, Any], int, int, list[dict[str, Any]], Exception | None]]:
+    jobs = []
+    for s in series:
+        if keep is not None:
+            args = (keep[0], keep[1], None)
+        else:
+            rule = get_retention_for_series(s, retention_index)
+            if not rule:
+                continue
+            args = retention_args(rule)
+        jobs.append((s, args))
+    sem = asyncio.Semaphore(SERIES_FETCH_CONCURRENCY)
+    results = await asyncio.gather(
+        *[process_series(sonarr, s, *args, dry_run, sem) for s, args in jobs],
+        return_exceptions=True,
+    )
+    out = []
+    for (s, _), result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            result = (0, 0, [], result)
+        out.append((s, *result))
+    return out
@@ -117,7 +117,11 @@ async function runCleanup(dryRun) {
     const msg = dryRun
       ? `Would delete ${data.deleted} files, unmonitor ${data.unmonitored} episodes across ${data.series_processed} series.`
       : `Deleted ${data.deleted} files, unmonitored ${data.unmonitored} episodes across ${data.series_processed} series.`;
-    showToast(msg);
+    if (data.failed) {
+      showToast(`${msg} ${data.failed} series failed, see Logs.`, "error");
+    } else {
+      showToast(msg);
+    }
     if (!dryRun) await loadSeries();
   } catch (e) {
     showToast("Error: " + e.message, "error");